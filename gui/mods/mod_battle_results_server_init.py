@@ -1,19 +1,65 @@
-from debug_utils import LOG_CURRENT_EXCEPTION
+from timeit import default_timer
+
+from debug_utils import LOG_CURRENT_EXCEPTION, LOG_NOTE
+from PlayerEvents import g_playerEvents
+
+# defer importing and starting the server until the first account login,
+# so that the mod adds next to nothing to the loading time of the client
+LAZY_STARTUP = True
+
+_server_started = False
 
 
 def init():
     try:
-        from mod_battle_results_server import g_battle_results_server
+        start = default_timer()
+
+        if LAZY_STARTUP:
+            g_playerEvents.onAccountBecomePlayer += _on_account_become_player
+        else:
+            _start_server(account_is_player=False)
 
-        g_battle_results_server.serve()
+        LOG_NOTE(
+            "Battle results server init took {:.2f} ms".format(
+                (default_timer() - start) * 1000
+            )
+        )
     except Exception:
         LOG_CURRENT_EXCEPTION()
 
 
 def fini():
     try:
-        from mod_battle_results_server import g_battle_results_server
+        if not _server_started:
+            g_playerEvents.onAccountBecomePlayer -= _on_account_become_player
+        else:
+            from mod_battle_results_server import g_battle_results_server
 
-        g_battle_results_server.close()
+            g_battle_results_server.close()
     except Exception:
         LOG_CURRENT_EXCEPTION()
+
+
+def _on_account_become_player(*_, **__):
+    try:
+        g_playerEvents.onAccountBecomePlayer -= _on_account_become_player
+
+        start = default_timer()
+        _start_server(account_is_player=True)
+
+        LOG_NOTE(
+            "Deferred battle results server startup took {:.2f} ms".format(
+                (default_timer() - start) * 1000
+            )
+        )
+    except Exception:
+        LOG_CURRENT_EXCEPTION()
+
+
+def _start_server(account_is_player):
+    global _server_started
+
+    from mod_battle_results_server import g_battle_results_server
+
+    g_battle_results_server.serve(account_is_player)
+    _server_started = True
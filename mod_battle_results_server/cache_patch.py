@@ -2,8 +2,15 @@ from mod_async import AsyncMutex, AsyncValue, async_task, auto_run
 from mod_hooking.strategy import override
 from shared_utils.account_helpers.BattleResultsCache import BattleResultsCache
 
+_patch_applied = False
+
 
 def apply_patch():
+    global _patch_applied
+    if _patch_applied:
+        return
+    _patch_applied = True
+
     mutex = AsyncMutex()
 
     @override(BattleResultsCache, "get")
@@ -1,32 +1,42 @@
 from collections import deque
+from typing import Optional
 
+import BigWorld
 from chat_shared import SYS_MESSAGE_TYPE
-from debug_utils import LOG_NOTE
+from debug_utils import LOG_CURRENT_EXCEPTION
 from Event import Event
 from gui.shared.gui_items.processors.common import BattleResultsGetter
 from messenger.proto.events import g_messengerEvents
 from mod_async import async_task, auto_run, from_adisp
 from mod_battle_results_server.cache_patch import apply_patch
+from mod_battle_results_server.io_worker import log_note
+from mod_battle_results_server.metadata import Metadata
 from mod_battle_results_server.serialization import serialize_battle_results
+from mod_battle_results_server.tracing import g_tracer
 from mod_battle_results_server.util import get, safe_callback
 from PlayerEvents import g_playerEvents
 
-apply_patch()
-
 
 class BattleResultsFetcher(object):
-    def __init__(self):
+    def __init__(self, metadata=None):
+        # type: (Optional[Metadata]) -> None
+        self._metadata = metadata
         self.battle_result_fetched = Event()
+        self.battle_results_drained = Event()
         self._stopped = True
         self._account_is_player = False
+        self._account_dbid = None
         self._fetching = False
         self._queue = deque()
 
-    def start(self):
+    def start(self, account_is_player=False):
+        apply_patch()
         self._stopped = False
         g_playerEvents.onAccountBecomePlayer += self._on_account_become_player
         g_playerEvents.onAccountBecomeNonPlayer += self._on_account_become_non_player
         g_messengerEvents.serviceChannel.onChatMessageReceived += self._on_sys_message
+        if account_is_player:
+            self._on_account_become_player()
 
     def stop(self):
         self._stopped = True
@@ -34,9 +44,14 @@ class BattleResultsFetcher(object):
         g_playerEvents.onAccountBecomeNonPlayer -= self._on_account_become_non_player
         g_messengerEvents.serviceChannel.onChatMessageReceived -= self._on_sys_message
 
+    @property
+    def account_dbid(self):
+        return self._account_dbid
+
     @safe_callback
     def _on_account_become_player(self, *_, **__):
         self._account_is_player = True
+        self._account_dbid = getattr(BigWorld.player(), "databaseID", None)
         self._fetch_battle_results()
 
     @safe_callback
@@ -49,10 +64,20 @@ class BattleResultsFetcher(object):
             arena_unique_id = get(message.data, "arenaUniqueID")
             if arena_unique_id is not None:
                 self._queue.append(arena_unique_id)
-                LOG_NOTE("Queued battle result {}".format(arena_unique_id))
+                log_note("Queued battle result {}".format(arena_unique_id))
                 if self._account_is_player:
                     self._fetch_battle_results()
 
+    def _get_metadata(self):
+        if self._metadata is None:
+            return None
+
+        try:
+            return self._metadata.get()
+        except Exception:
+            LOG_CURRENT_EXCEPTION()
+            return None
+
     @auto_run
     @async_task
     def _fetch_battle_results(self):
@@ -66,18 +91,31 @@ class BattleResultsFetcher(object):
             ):
                 arena_unique_id = self._queue.popleft()
                 if arena_unique_id > 0:
-                    LOG_NOTE("Fetching battle result {}".format(arena_unique_id))
-                    response = yield from_adisp(
-                        BattleResultsGetter(arena_unique_id).request()
+                    log_note("Fetching battle result {}".format(arena_unique_id))
+                    span = g_tracer.async_span(
+                        "fetch_battle_result", arenaUniqueID=arena_unique_id
                     )
+                    try:
+                        response = yield from_adisp(
+                            BattleResultsGetter(arena_unique_id).request()
+                        )
+                        span.set(success=response.success)
+                    finally:
+                        span.finish()
                     if response.success:
-                        LOG_NOTE("Fetched battle result {}".format(arena_unique_id))
-                        battle_result = serialize_battle_results(response.auxData)
-                        self.battle_result_fetched(battle_result)
+                        log_note("Fetched battle result {}".format(arena_unique_id))
+                        with g_tracer.span(
+                            "battle_result_fetched", arenaUniqueID=arena_unique_id
+                        ):
+                            battle_result = serialize_battle_results(
+                                response.auxData, self._get_metadata()
+                            )
+                            self.battle_result_fetched(battle_result)
                     else:
-                        LOG_NOTE(
+                        log_note(
                             "Failed fetching battle result {}".format(arena_unique_id)
                         )
 
         finally:
             self._fetching = False
+            self.battle_results_drained()
@@ -0,0 +1,153 @@
+import threading
+from collections import OrderedDict
+from Queue import Empty, Full, Queue
+
+from debug_utils import LOG_CURRENT_EXCEPTION, LOG_NOTE
+from mod_async import AsyncValue
+
+# number of pending writes after which further writes are dropped
+IO_QUEUE_SIZE = 1024
+# maximum number of writes which are handled in one go
+IO_BATCH_SIZE = 64
+
+_LOG = "log"
+_WRITE = "write"
+_RUN = "run"
+_STOP = "stop"
+
+
+class IOWorker(object):
+    """
+    Moves log and file writes off the game thread. Writes are put into a bounded queue
+    which is drained in batches by a worker thread. Writes are dropped (and counted)
+    when the queue is full instead of blocking the game thread. Log lines still end up
+    in python.log. While the worker thread isn't running, writes are done right away.
+    Other blocking I/O can be handed to the worker with `run`, its result is passed
+    back to the game thread by `poll`.
+    """
+
+    def __init__(self, max_queue_size=IO_QUEUE_SIZE, batch_size=IO_BATCH_SIZE):
+        self._queue = Queue(max_queue_size)
+        self._batch_size = batch_size
+        self._completed = Queue()
+        self._thread = None
+        self.dropped_writes = 0
+        self.failed_writes = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run, name="BattleResultsServerIO")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def log_note(self, message):
+        self._put((_LOG, None, message))
+
+    def write_file(self, path, data):
+        self._put((_WRITE, path, data))
+
+    def run(self, func):
+        # type: (Callable[[], Any]) -> AsyncValue
+        # resolves to the return value of `func`, or None if it raised
+        result = AsyncValue()
+        if self._thread is None:
+            result.set(_call(func))
+            return result
+
+        try:
+            self._queue.put_nowait((_RUN, result, func))
+        except Full:
+            # unlike writes, a result is expected, so it can't be dropped
+            result.set(_call(func))
+        return result
+
+    def poll(self):
+        # hands the results of `run` back, needs to be called on the game thread
+        while True:
+            try:
+                result, value = self._completed.get_nowait()
+            except Empty:
+                return
+            result.set(value)
+
+    def close(self, timeout=1.0):
+        # flushes all pending writes before the worker thread is stopped
+        if self._thread is None:
+            return
+
+        try:
+            self._queue.put((_STOP, None, None), timeout=timeout)
+        except Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+
+    def stats(self):
+        return {
+            "droppedWrites": self.dropped_writes,
+            "failedWrites": self.failed_writes,
+        }
+
+    def _put(self, item):
+        if self._thread is None:
+            self._write_batch([item])
+            return
+
+        try:
+            self._queue.put_nowait(item)
+        except Full:
+            self.dropped_writes += 1
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+
+            running = all(kind != _STOP for kind, _, _ in batch)
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        files = OrderedDict()
+        for kind, path, data in batch:
+            if kind == _LOG:
+                LOG_NOTE(data)
+            elif kind == _WRITE:
+                # only the latest content of a file needs to be written
+                files.pop(path, None)
+                files[path] = data
+            elif kind == _RUN:
+                # runs carry the AsyncValue and the function instead of path and data
+                result, func = path, data
+                self._completed.put((result, _call(func)))
+
+        for path, data in files.iteritems():
+            self._write(path, data)
+
+    def _write(self, path, data):
+        try:
+            with open(path, "w") as output_file:
+                output_file.write(data)
+        except (IOError, OSError):
+            self.failed_writes += 1
+
+
+def _call(func):
+    try:
+        return func()
+    except Exception:
+        LOG_CURRENT_EXCEPTION()
+        return None
+
+
+g_io_worker = IOWorker()
+
+
+def log_note(message):
+    g_io_worker.log_note(message)
@@ -1,6 +1,8 @@
 from collections import namedtuple
+from typing import Optional
 
 from debug_utils import LOG_CURRENT_EXCEPTION
+from mod_async import AsyncValue, async_task, auto_run
 from mod_battle_results_server.parser import (
     Any,
     Fail,
@@ -14,8 +16,12 @@ from mod_battle_results_server.parser import (
     field,
     parse,
 )
+from mod_battle_results_server.rate_limit import LoadShedder, TokenBucket
+from mod_battle_results_server.response_cache import ResponseCache
+from mod_battle_results_server.tracing import g_tracer
 from mod_battle_results_server.util import (
     JsonParseError,
+    RawJson,
     get,
     parse_json,
     serialize_to_json,
@@ -74,6 +80,19 @@ def make_success_response(response):
     return {"jsonrpc": "2.0", "result": response.result, "id": response.id}
 
 
+def serialize_response(response):
+    if isinstance(response, list):
+        return "[" + ", ".join(serialize_response(single) for single in response) + "]"
+
+    result = response.get("result")
+    if isinstance(result, RawJson):
+        return '{{"jsonrpc": "2.0", "result": {result}, "id": {id}}}'.format(
+            result=result.json, id=serialize_to_json(response["id"])
+        )
+
+    return serialize_to_json(response)
+
+
 def make_error_response(response):
     return {
         "jsonrpc": "2.0",
@@ -86,59 +105,190 @@ def make_error_response(response):
     }
 
 
+class Context(object):
+    """
+    Per connection state which is passed to the handlers of a shared `Dispatcher`.
+    """
+
+    __slots__ = ("rate_limiter",)
+
+    def __init__(self, rate_limiter=None):
+        # type: (Optional[TokenBucket]) -> None
+        self.rate_limiter = rate_limiter
+
+
 class Dispatcher(object):
-    def __init__(self):
+    def __init__(
+        self,
+        load_shedder=None,  # type: Optional[LoadShedder]
+        bytes_per_token=None,  # type: Optional[int]
+        response_cache=None,  # type: Optional[ResponseCache]
+        max_batch_size=None,  # type: Optional[int]
+    ):
+        # type: (...) -> None
         self._handlers = dict()
+        self._load_shedder = load_shedder
+        self._bytes_per_token = bytes_per_token
+        self._response_cache = response_cache
+        self._max_batch_size = max_batch_size
+
+    def __call__(self, context, data):
+        # type: (Context, str) -> ...
+        with g_tracer.span("dispatch", size=len(data)):
+            return self._dispatch(context, data)
 
-    def __call__(self, data):
+    def _dispatch(self, context, data):
         try:
             json = parse_json(data)
         except JsonParseError as e:
-            response = ErrorResponse(-32700, "Parse error", str(e), None)
-            return serialize_to_json(make_error_response(response))
+            # malformed messages are limited like a single request
+            json = None
+            parse_error = ErrorResponse(-32700, "Parse error", str(e), None)
         else:
-            response = self._handle(json)
-            if response:
-                return serialize_to_json(response)
-            return None
+            parse_error = None
+
+        request_count = len(json) if isinstance(json, list) else 1
+        rate_limiter = context.rate_limiter
+
+        if self._max_batch_size is not None and request_count > self._max_batch_size:
+            max_batch_size = {"maxBatchSize": self._max_batch_size}
+            return serialize_to_json(
+                make_error_response(
+                    ErrorResponse(-32002, "Batch too large", max_batch_size, None)
+                )
+            )
+
+        if self._load_shedder is not None and self._load_shedder.overloaded:
+            self._load_shedder.shed_requests += request_count
+            response = self._reject(json, -32000, "Server overloaded", None)
+        elif rate_limiter is not None and not rate_limiter.try_acquire(request_count):
+            if self._load_shedder is not None:
+                self._load_shedder.rate_limited_requests += request_count
+            retry_after = {"retryAfter": rate_limiter.retry_after(request_count)}
+            response = self._reject(json, -32001, "Rate limit exceeded", retry_after)
+            # rejected requests are not charged, otherwise retryAfter would be wrong
+            return serialize_response(response) if response else None
+        elif parse_error is not None:
+            response = make_error_response(parse_error)
+        elif self._load_shedder is not None:
+            with self._load_shedder.measure():
+                response = self._handle(context, json)
+        else:
+            response = self._handle(context, json)
+
+        if isinstance(response, AsyncValue):
+            serialized = AsyncValue()
+            self._complete_pending(context, response, serialized)
+            return serialized
+
+        return self._complete(context, response)
+
+    def add_method(self, param_parser=Any(), is_async=False, cache_key=None):
+        # `cache_key` maps the parsed params to the key under which the result is cached,
+        # params which yield the same result need to map to the same key
+        if is_async and cache_key is not None:
+            raise ValueError("Async methods can't be cached.")
 
-    def add_method(self, param_parser=Any()):
         def decorator(handler):
-            self._handlers[handler.__name__] = (handler, param_parser)
+            self._handlers[handler.__name__] = (
+                handler,
+                param_parser,
+                is_async,
+                cache_key,
+            )
             return handler
 
         return decorator
 
-    def _handle(self, json):
+    def _complete(self, context, response):
+        serialized = serialize_response(response) if response else None
+
+        # the requests themselves have already been charged when they were admitted
+        if context.rate_limiter is not None and serialized and self._bytes_per_token:
+            context.rate_limiter.charge(len(serialized) / float(self._bytes_per_token))
+
+        return serialized
+
+    @auto_run
+    @async_task
+    def _complete_pending(self, context, pending, serialized):
+        response = yield pending
+        serialized.set(self._complete(context, response))
+
+    def _handle(self, context, json):
         if isinstance(json, list):
-            return self._handle_batch(json)
+            return self._handle_batch(context, json)
         else:
-            return self._handle_single(json)
+            return self._handle_single(context, json)
+
+    def _handle_batch(self, context, batch):
+        responses = [self._handle_single(context, single) for single in batch]
+        if any(isinstance(response, AsyncValue) for response in responses):
+            gathered = AsyncValue()
+            self._gather_batch(responses, gathered)
+            return gathered
+        return self._filter_batch(responses)
+
+    @auto_run
+    @async_task
+    def _gather_batch(self, pending, gathered):
+        responses = []
+        for response in pending:
+            if isinstance(response, AsyncValue):
+                response = yield response
+            responses.append(response)
+        gathered.set(self._filter_batch(responses))
 
-    def _handle_batch(self, batch):
-        responses = [self._handle_single(single) for single in batch]
+    @staticmethod
+    def _filter_batch(responses):
         filtered = [response for response in responses if response is not None]
         if len(filtered) > 0:
             return filtered
         return None
 
-    def _handle_single(self, single):
+    def _reject(self, json, code, message, data):
+        if isinstance(json, list):
+            responses = [
+                self._reject_single(single, code, message, data) for single in json
+            ]
+            return self._filter_batch(responses)
+        else:
+            return self._reject_single(json, code, message, data)
+
+    def _reject_single(self, single, code, message, data):
         try:
             request = parse(request_parser, single)
-        except ParserError as e:
-            return make_error_response(
-                ErrorResponse(-32600, "Invalid Request", str(e), None)
-            )
+        except ParserError:
+            request_id = None
         else:
-            if isinstance(request, Request):
-                return self._handle_request(request.method, request.params, request.id)
-            else:
-                self._handle_request(request.method, request.params, None)
+            if not isinstance(request, Request):
                 return None
+            request_id = request.id
+
+        return make_error_response(ErrorResponse(code, message, data, request_id))
 
-    def _handle_request(self, method, params, request_id):
+    def _handle_single(self, context, single):
+        with g_tracer.span("handle_single") as span:
+            try:
+                request = parse(request_parser, single)
+            except ParserError as e:
+                return make_error_response(
+                    ErrorResponse(-32600, "Invalid Request", str(e), None)
+                )
+            else:
+                if isinstance(request, Request):
+                    span.set(method=request.method, id=request.id)
+                    return self._handle_request(
+                        context, request.method, request.params, request.id
+                    )
+                else:
+                    span.set(method=request.method)
+                    self._handle_request(context, request.method, request.params, None)
+                    return None
+
+    def _handle_request(self, context, method, params, request_id):
         try:
-            handler, param_parser = self._handlers[method]
+            handler, param_parser, is_async, cache_key = self._handlers[method]
         except KeyError:
             return make_error_response(
                 ErrorResponse(-32601, "Method not found", None, request_id)
@@ -151,10 +301,44 @@ class Dispatcher(object):
                 ErrorResponse(-32602, "Invalid params", str(e), request_id)
             )
 
+        if is_async:
+            response = AsyncValue()
+            self._handle_async_request(handler, context, params, request_id, response)
+            return response
+
+        cacheable = cache_key is not None and self._response_cache is not None
+        if cacheable:
+            key = (method, cache_key(params))
+            result = self._response_cache.get(key)
+            if result is not None:
+                return make_success_response(SuccessResponse(result, request_id))
+
         try:
-            return make_success_response(SuccessResponse(handler(params), request_id))
+            result = handler(context, params)
         except Exception:
             LOG_CURRENT_EXCEPTION()
             return make_error_response(
                 ErrorResponse(-32603, "Internal error", None, request_id)
             )
+
+        if cacheable:
+            if not isinstance(result, RawJson):
+                result = RawJson(serialize_to_json(result))
+            self._response_cache.put(key, result)
+
+        return make_success_response(SuccessResponse(result, request_id))
+
+    @auto_run
+    @async_task
+    def _handle_async_request(self, handler, context, params, request_id, response):
+        try:
+            result = yield handler(context, params)
+        except Exception:
+            LOG_CURRENT_EXCEPTION()
+            response.set(
+                make_error_response(
+                    ErrorResponse(-32603, "Internal error", None, request_id)
+                )
+            )
+        else:
+            response.set(make_success_response(SuccessResponse(result, request_id)))
@@ -0,0 +1,158 @@
+import os
+from typing import Optional
+
+from debug_utils import LOG_CURRENT_EXCEPTION
+from mod_async import AsyncValue, async_task, auto_run
+from mod_battle_results_server.io_worker import g_io_worker, log_note
+from mod_battle_results_server.util import (
+    JsonParseError,
+    RawJson,
+    get_data_dir,
+    parse_json,
+    serialize_to_json,
+)
+
+METADATA_FILE_NAME = "battle_results_server_metadata.json"
+
+
+class Metadata(object):
+    """
+    Lookup tables for vehicles, maps and bonus types which are built from the data of
+    the game client. The tables are cached on disk until the client version changes.
+    `load` reads the cache on the I/O worker, `get` loads synchronously if needed.
+    """
+
+    def __init__(self, cache_dir=None):
+        self._cache_dir = cache_dir
+        self._tables = None
+        self._encoded = None
+        self._loaded = None  # type: Optional[AsyncValue]
+
+    def load(self):
+        # type: () -> AsyncValue
+        # resolves to the encoded tables, or None if they couldn't be built
+        if self._loaded is None:
+            self._loaded = AsyncValue()
+            self._load_async(self._loaded)
+        return self._loaded
+
+    def get(self):
+        if self._tables is None:
+            self._set_tables(get_client_version(), read_cache(self._get_cache_path()))
+        return self._tables
+
+    @auto_run
+    @async_task
+    def _load_async(self, loaded):
+        path = self._get_cache_path()
+        cached = yield g_io_worker.run(lambda: read_cache(path))
+        try:
+            self._set_tables(get_client_version(), cached)
+        except Exception:
+            LOG_CURRENT_EXCEPTION()
+            # try again on the next request
+            self._loaded = None
+        loaded.set(self._encoded)
+
+    def _set_tables(self, client_version, cached):
+        if self._tables is not None:
+            return
+
+        if cached is not None:
+            tables, encoded = cached
+            if tables.get("clientVersion") == client_version:
+                self._tables = tables
+                self._encoded = RawJson(encoded)
+                return
+
+        log_note("Building metadata for client version {}".format(client_version))
+        tables = build_metadata()
+        tables["clientVersion"] = client_version
+        encoded = serialize_to_json(tables)
+
+        self._tables = tables
+        self._encoded = RawJson(encoded)
+        self._write_cache(encoded)
+
+    def _get_cache_path(self):
+        cache_dir = self._cache_dir
+        if cache_dir is None:
+            cache_dir = get_data_dir()
+        return os.path.join(cache_dir, METADATA_FILE_NAME)
+
+    def _write_cache(self, encoded):
+        g_io_worker.write_file(self._get_cache_path(), encoded)
+
+
+def read_cache(path):
+    # runs on the I/O worker, returns the parsed and the encoded tables
+    try:
+        with open(path, "r") as cache_file:
+            encoded = cache_file.read()
+    except (IOError, OSError):
+        return None
+
+    try:
+        tables = parse_json(encoded)
+    except JsonParseError:
+        return None
+
+    if not isinstance(tables, dict):
+        return None
+    return tables, encoded
+
+
+def get_client_version():
+    from helpers import getClientVersion
+
+    return getClientVersion()
+
+
+def build_metadata():
+    return {
+        "vehicles": build_vehicle_table(),
+        "arenas": build_arena_table(),
+        "bonusTypes": build_bonus_type_table(),
+    }
+
+
+def build_vehicle_table():
+    import nations
+    from items import vehicles
+
+    table = dict()
+    for nation_name, nation_id in nations.INDICES.iteritems():
+        for compact_descr, item in vehicles.g_list.getList(nation_id).iteritems():
+            classes = vehicles.VEHICLE_CLASS_TAGS & item.tags
+            table[str(compact_descr)] = {
+                "name": item.name,
+                "userString": item.userString,
+                "shortUserString": item.shortUserString,
+                "nation": nation_name,
+                "tier": item.level,
+                "class": next(iter(classes), None),
+            }
+
+    return table
+
+
+def build_arena_table():
+    import ArenaType
+
+    table = dict()
+    for arena_type_id, arena_type in ArenaType.g_cache.iteritems():
+        table[str(arena_type_id)] = {
+            "name": arena_type.name,
+            "geometryName": arena_type.geometryName,
+            "gameplayName": arena_type.gameplayName,
+        }
+
+    return table
+
+
+def build_bonus_type_table():
+    from constants import ARENA_BONUS_TYPE_NAMES
+
+    return {
+        str(bonus_type): name for name, bonus_type in ARENA_BONUS_TYPE_NAMES.iteritems()
+    }
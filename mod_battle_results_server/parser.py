@@ -203,3 +203,74 @@ class OneOf(Parser):
 class Nullable(OneOf):
     def __init__(self, value_parser):
         super(Nullable, self).__init__(Null(), value_parser)
+
+
+class AllOf(Parser):
+    def __init__(self, *parsers):
+        if len(parsers) == 0:
+            raise ValueError("At least one parser is required.")
+
+        self._parsers = parsers
+
+    def parse(self, path, value):
+        for parser in self._parsers:
+            parser.parse(path, value)
+        return value
+
+
+class Member(Parser):
+    def __init__(self, values):
+        self._values = frozenset(values)
+
+    def parse(self, path, value):
+        if value not in self._values:
+            raise ParserError(
+                "Expected {path} to be one of {values}.".format(
+                    path=path, values=sorted(self._values)
+                )
+            )
+        return value
+
+
+class Satisfies(Parser):
+    def __init__(self, predicate, description):
+        self._predicate = predicate
+        self._description = description
+
+    def parse(self, path, value):
+        if not self._predicate(value):
+            raise ParserError(
+                "Expected {path} to be {description}.".format(
+                    path=path, description=self._description
+                )
+            )
+        return value
+
+
+class Contains(Parser):
+    def __init__(self, value_parser):
+        self._value_parser = value_parser
+
+    def parse(self, path, value):
+        if isinstance(value, dict):
+            items = value.iteritems()
+        elif isinstance(value, list):
+            items = enumerate(value)
+        else:
+            raise ParserError(
+                "Expected {path} to be an object or an array.".format(path=path)
+            )
+
+        for key, contained_value in items:
+            try:
+                self._value_parser.parse(
+                    "{path}[{key}]".format(path=path, key=key), contained_value
+                )
+            except ParserError:
+                continue
+            else:
+                return value
+
+        raise ParserError(
+            "Expected {path} to contain at least one matching value.".format(path=path)
+        )
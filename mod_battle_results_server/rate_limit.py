@@ -0,0 +1,82 @@
+from timeit import default_timer
+
+
+class TokenBucket(object):
+    """
+    Token bucket which is allowed to go into debt. Requests are only admitted if the
+    bucket holds enough tokens for them. Costs which are only known afterwards (e.g.
+    the size of the response) are charged later and may put the bucket into debt.
+    """
+
+    def __init__(self, rate, capacity, clock=default_timer):
+        self._rate = float(rate)
+        self._capacity = float(capacity)
+        self._clock = clock
+        self._tokens = self._capacity
+        self._last_refill = clock()
+
+    def try_acquire(self, cost):
+        self._refill()
+        if self._tokens < cost:
+            return False
+        self._tokens -= cost
+        return True
+
+    def charge(self, cost):
+        self._refill()
+        self._tokens -= cost
+
+    def retry_after(self, cost):
+        # seconds until `try_acquire(cost)` succeeds, rejected requests are not charged
+        self._refill()
+        if self._tokens >= cost:
+            return 0
+        return (cost - self._tokens) / self._rate
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._tokens = min(self._capacity, self._tokens + elapsed * self._rate)
+
+
+class LoadShedder(object):
+    """
+    Global budget for the time spent handling requests during a single frame.
+    Once the budget is used up, requests are shed until the next frame starts.
+    """
+
+    def __init__(self, frame_budget, clock=default_timer):
+        self._frame_budget = frame_budget
+        self._clock = clock
+        self._spent = 0.0
+        self.shed_requests = 0
+        self.rate_limited_requests = 0
+
+    def start_frame(self):
+        self._spent = 0.0
+
+    @property
+    def overloaded(self):
+        return self._spent >= self._frame_budget
+
+    def measure(self):
+        return _Measurement(self)
+
+    def stats(self):
+        return {
+            "shedRequests": self.shed_requests,
+            "rateLimitedRequests": self.rate_limited_requests,
+        }
+
+
+class _Measurement(object):
+    def __init__(self, load_shedder):
+        self._load_shedder = load_shedder
+        self._start = None
+
+    def __enter__(self):
+        self._start = self._load_shedder._clock()
+
+    def __exit__(self, *_):
+        self._load_shedder._spent += self._load_shedder._clock() - self._start
@@ -0,0 +1,65 @@
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    """
+    LRU cache for the serialized results (`RawJson`) of pure methods. Entries are only
+    valid for the generation of the store they have been computed from, the whole cache
+    is dropped once the generation changes. The cache is bounded by the number of
+    entries and by their total size in bytes.
+    """
+
+    def __init__(self, max_size, max_bytes, generation):
+        # type: (int, int, Callable[[], int]) -> None
+        self._max_size = max_size
+        self._max_bytes = max_bytes
+        self._generation = generation
+        self._entries_generation = None
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        self._drop_stale()
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        # re-insert to mark the entry as most recently used
+        self._entries[key] = entry
+        self.hits += 1
+        return entry
+
+    def put(self, key, value):
+        self._drop_stale()
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._total_bytes -= len(previous.json)
+
+        size = len(value.json)
+        if size > self._max_bytes:
+            return
+
+        self._entries[key] = value
+        self._total_bytes += size
+        while (
+            len(self._entries) > self._max_size or self._total_bytes > self._max_bytes
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            self._total_bytes -= len(evicted.json)
+
+    def stats(self):
+        return {
+            "cacheHits": self.hits,
+            "cacheMisses": self.misses,
+            "cacheBytes": self._total_bytes,
+        }
+
+    def _drop_stale(self):
+        generation = self._generation()
+        if generation != self._entries_generation:
+            self._entries.clear()
+            self._total_bytes = 0
+            self._entries_generation = generation
@@ -0,0 +1,65 @@
+import time
+from collections import deque, namedtuple
+
+RetentionPolicy = namedtuple("RetentionPolicy", ("max_records", "max_bytes", "max_age"))
+
+
+class RecordStore(object):
+    """
+    Keeps the battle result records of the session within the limits of a retention
+    policy. Records must be appended in chronological order and need to have a
+    `timestamp` and a `size` (in encoded bytes). The oldest records are evicted first.
+    """
+
+    def __init__(self, policy, clock=time.time):
+        # type: (RetentionPolicy, Callable[[], float]) -> None
+        self._policy = policy
+        self._clock = clock
+        self._records = deque()
+        self._total_bytes = 0
+        self.evicted_records = 0
+        # timestamp of the newest evicted record
+        self.evicted_until = None
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def append(self, record):
+        self._records.append(record)
+        self._total_bytes += record.size
+        self.evict()
+
+    def add_size(self, record, size):
+        # for encodings which are added to a retained record later on,
+        # the limits are enforced by the next call to `append` or `evict`
+        record.size += size
+        self._total_bytes += size
+
+    def evict(self):
+        # returns the number of evicted records, records also expire without appends
+        evicted_records = self.evicted_records
+        min_timestamp = self._clock() - self._policy.max_age
+        while len(self._records) > 0 and (
+            len(self._records) > self._policy.max_records
+            or self._total_bytes > self._policy.max_bytes
+            or self._records[0].timestamp < min_timestamp
+        ):
+            record = self._records.popleft()
+            self._total_bytes -= record.size
+            self.evicted_records += 1
+            self.evicted_until = record.timestamp
+        return self.evicted_records - evicted_records
+
+    def stats(self):
+        return {
+            "records": len(self._records),
+            "recordBytes": self._total_bytes,
+            "evictedRecords": self.evicted_records,
+        }
@@ -1,13 +1,38 @@
 from copy import deepcopy
 from enum import Enum
 
+from mod_battle_results_server.tracing import g_tracer
 from mod_battle_results_server.util import get, unset
 
 
-def serialize_battle_results(results):
+def serialize_battle_results(results, metadata=None):
     # source: BattleReplay.__onBattleResultsReceived
-    sanitized = sanitize_battle_results(results)
-    return encode_obj(sanitized)
+    with g_tracer.span("serialize_battle_results"):
+        sanitized = sanitize_battle_results(results)
+        serialized = encode_obj(sanitized)
+        if metadata is not None:
+            enrich_battle_results(serialized, metadata)
+        return serialized
+
+
+def enrich_battle_results(serialized, metadata):
+    # adds the metadata of the vehicles, the map and the bonus type of the battle
+    vehicle_table = metadata.get("vehicles", {})
+    vehicles = dict()
+    for player_vehicles in (get(serialized, "vehicles") or {}).itervalues():
+        for vehicle in player_vehicles:
+            compact_descr = str(get(vehicle, "typeCompDescr"))
+            if compact_descr in vehicle_table:
+                vehicles[compact_descr] = vehicle_table[compact_descr]
+
+    arena_type_id = str(get(serialized, "common", "arenaTypeID"))
+    bonus_type = str(get(serialized, "common", "bonusType"))
+
+    serialized["metadata"] = {
+        "vehicles": vehicles,
+        "arena": get(metadata, "arenas", arena_type_id),
+        "bonusType": get(metadata, "bonusTypes", bonus_type),
+    }
 
 
 def sanitize_battle_results(results):
@@ -71,3 +96,46 @@ def encode_long(obj):
 
 def encode_enum(obj):
     return obj.value
+
+
+def columnarize_battle_results(serialized):
+    # turns the per vehicle / per player sections of serialized battle results into
+    # column arrays, see "Columnar Encoding" in the README for the mapping
+    columnarized = dict(serialized)
+
+    vehicles = get(serialized, "vehicles")
+    if vehicles is not None:
+        columnarized["vehicles"] = encode_columns(
+            (vehicle_id, vehicle)
+            for vehicle_id, player_vehicles in vehicles.iteritems()
+            for vehicle in player_vehicles
+        )
+
+    players = get(serialized, "players")
+    if players is not None:
+        columnarized["players"] = encode_columns(players.iteritems())
+
+    return columnarized
+
+
+def encode_columns(rows):
+    # rows which lack a column are listed in `missing`, so that they can be told
+    # apart from rows which hold an actual null
+    keys = []
+    columns = dict()
+    missing = dict()
+    for index, (key, row) in enumerate(rows):
+        keys.append(key)
+        for name, value in row.iteritems():
+            column = columns.get(name)
+            if column is None:
+                column = columns[name] = [None] * index
+                if index > 0:
+                    missing[name] = range(index)
+            column.append(value)
+        for name, column in columns.iteritems():
+            if len(column) == index:
+                column.append(None)
+                missing.setdefault(name, []).append(index)
+
+    return {"keys": keys, "columns": columns, "missing": missing}
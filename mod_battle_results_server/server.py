@@ -1,19 +1,38 @@
 import re
 import time
-from collections import namedtuple
-from typing import Any, List
+from collections import OrderedDict, deque, namedtuple
+from typing import Any, Dict, List, Optional, Union
 
-from debug_utils import LOG_NOTE
-from mod_async import CallbackCancelled, async_task, auto_run, delay
+from mod_async import AsyncValue, CallbackCancelled, async_task, auto_run, delay
 from mod_async_server import Server
 from mod_battle_results_server.fetcher import BattleResultsFetcher
+from mod_battle_results_server.io_worker import g_io_worker, log_note
 from mod_battle_results_server.json_rpc import (
+    Context,
     Dispatcher,
     Notification,
     make_notification,
 )
-from mod_battle_results_server.parser import Nullable, Number, Record, field
-from mod_battle_results_server.util import get, serialize_to_json
+from mod_battle_results_server.metadata import Metadata
+from mod_battle_results_server.parser import Boolean, Nullable, Number, Record, field
+from mod_battle_results_server.rate_limit import LoadShedder, TokenBucket
+from mod_battle_results_server.response_cache import ResponseCache
+from mod_battle_results_server.retention import RecordStore, RetentionPolicy
+from mod_battle_results_server.serialization import columnarize_battle_results
+from mod_battle_results_server.subscription import (
+    SUBSCRIBE_PARAMS,
+    Subscription,
+    create_subscription,
+    matches,
+)
+from mod_battle_results_server.tracing import g_tracer
+from mod_battle_results_server.util import (
+    RawJson,
+    get,
+    parse_json,
+    serialize_to_json,
+    serialize_with_raw_json,
+)
 from mod_websocket_server import MessageStream, websocket_protocol
 
 PORT = 15455
@@ -23,91 +42,322 @@ ORIGIN_WHITELIST = [
     "https://lgfrbcsgo.github.io",
 ]
 
-BattleResultRecord = namedtuple("BattleResultRecord", ("timestamp", "battle_result"))
+# sustained number of requests per second and connection
+REQUEST_RATE = 10
+# number of requests a connection may burst before being rate limited
+REQUEST_BURST = 30
+# batches which are larger can never be admitted by the rate limiter
+MAX_BATCH_SIZE = REQUEST_BURST
+# number of responses per connection which may be pending before reading pauses
+MAX_PENDING_RESPONSES = 16
+# response bytes which cost as much as a single request
+BYTES_PER_TOKEN = 256 * 1024
+# time in seconds which may be spent handling requests per frame
+FRAME_BUDGET = 0.004
+# number of serialized responses of pure methods which are memoized
+RESPONSE_CACHE_SIZE = 32
+# total size of the memoized responses, on top of the retained battle results
+RESPONSE_CACHE_BYTES = 8 * 1024 * 1024
+# fraction of frames and fetches which are traced, 0 disables tracing
+TRACE_SAMPLE_RATE = 0.0
+TRACE_FILE = "battle_results_server_trace.json"
+# whether metadata of vehicles, maps and bonus types is added to battle results
+ENRICH_BATTLE_RESULTS = False
+# limits for the battle results which are kept for get_battle_results
+RETENTION_POLICY = RetentionPolicy(
+    max_records=500, max_bytes=32 * 1024 * 1024, max_age=48 * 60 * 60
+)
+
+PendingNotification = namedtuple("PendingNotification", ("params", "streams"))
+
+
+class BattleResultRecord(object):
+    __slots__ = ("timestamp", "battle_result", "columnar_battle_result", "size")
+
+    def __init__(self, timestamp, battle_result, size):
+        # type: (int, RawJson, int) -> None
+        self.timestamp = timestamp
+        self.battle_result = battle_result
+        # the columnar encoding is only built once a client asks for it
+        self.columnar_battle_result = None  # type: Optional[RawJson]
+        self.size = size
 
 
 @auto_run
 @async_task
-def notify(stream, method, params):
-    # type: (MessageStream, str, Any) -> ...
-    notification = make_notification(Notification(method, params))
-    data = serialize_to_json(notification)
+def send(stream, data):
+    # type: (MessageStream, str) -> ...
     yield stream.send_message(data)
 
 
+def notify(streams, method, params):
+    # type: (List[MessageStream], str, Any) -> None
+    if len(streams) == 0:
+        return
+
+    with g_tracer.span("notify", method=method, subscribers=len(streams)):
+        notification = make_notification(Notification(method, params))
+        data = serialize_with_raw_json(notification)
+        for stream in streams:
+            send(stream, data)
+
+
+class ResponseQueue(object):
+    def __init__(self, stream, max_pending):
+        # type: (MessageStream, int) -> None
+        self._stream = stream
+        self._max_pending = max_pending
+        self._pending = 0
+        self._capacity_available = None  # type: Optional[AsyncValue]
+        self._closed = False
+        self._sending = False
+        self._queue = deque()
+
+    def put(self, response):
+        # type: (Optional[Union[str, AsyncValue]]) -> None
+        if self._closed:
+            return
+
+        self._pending += 1
+        self._queue.append(response)
+        self._send_responses()
+
+    def wait_for_capacity(self):
+        # type: () -> AsyncValue
+        capacity_available = AsyncValue()
+        if self._closed or self._pending < self._max_pending:
+            capacity_available.set(None)
+        else:
+            self._capacity_available = capacity_available
+        return capacity_available
+
+    def close(self):
+        self._closed = True
+        self._queue.clear()
+        self._notify_capacity_available()
+
+    def _notify_capacity_available(self):
+        capacity_available = self._capacity_available
+        if capacity_available is not None:
+            self._capacity_available = None
+            capacity_available.set(None)
+
+    @auto_run
+    @async_task
+    def _send_responses(self):
+        if self._sending:
+            return
+
+        self._sending = True
+        try:
+            while not self._closed and len(self._queue) > 0:
+                response = self._queue.popleft()
+                if isinstance(response, AsyncValue):
+                    response = yield response
+                if response and not self._closed:
+                    yield self._stream.send_message(response)
+
+                self._pending -= 1
+                if self._pending < self._max_pending:
+                    self._notify_capacity_available()
+        except Exception:
+            # the stream is unusable, don't leave the protocol waiting for capacity
+            self.close()
+            raise
+        finally:
+            self._sending = False
+
+
 class Handlers(object):
-    def __init__(self, fetcher):
-        # type: (BattleResultsFetcher) -> None
-        self._subscribers = []  # type: List[MessageStream]
-        self._records = []  # type: List[BattleResultRecord]
+    def __init__(self, fetcher, retention_policy):
+        # type: (BattleResultsFetcher, RetentionPolicy) -> None
+        self._fetcher = fetcher
+        self._subscribers = OrderedDict()  # type: Dict[MessageStream, Subscription]
+        self._records = RecordStore(retention_policy)
+        self._pending_notifications = []  # type: List[PendingNotification]
+        self.generation = 0
         fetcher.battle_result_fetched += self._on_battle_result
+        fetcher.battle_results_drained += self._on_battle_results_drained
 
-    def subscribe(self, stream):
-        # type: (MessageStream) -> None
-        if stream not in self._subscribers:
-            self._subscribers.append(stream)
+    def subscribe(self, stream, params):
+        # type: (MessageStream, Any) -> None
+        self._subscribers[stream] = create_subscription(
+            params, lambda: self._fetcher.account_dbid
+        )
 
     def unsubscribe(self, stream):
         # type: (MessageStream) -> None
-        if stream in self._subscribers:
-            self._subscribers.remove(stream)
+        self._subscribers.pop(stream, None)
 
-    def get_battle_results(self, after):
-        # type: (int) -> ...
+    def get_battle_results(self, after, columnar=False):
+        # type: (int, bool) -> ...
         found = [record for record in self._records if record.timestamp > after]
         start = after if not found else min([record.timestamp for record in found])
         end = after if not found else max([record.timestamp for record in found])
 
-        return {
-            "start": start,
-            "end": end,
-            "battleResults": [record.battle_result for record in found],
-        }
+        if columnar:
+            battle_results = []
+            for record in found:
+                if record.columnar_battle_result is None:
+                    size = self._encode_columnar(
+                        record, parse_json(record.battle_result.json)
+                    )
+                    self._records.add_size(record, size)
+                battle_results.append(record.columnar_battle_result)
+        else:
+            battle_results = [record.battle_result for record in found]
+
+        return RawJson(
+            serialize_with_raw_json(
+                {
+                    "start": start,
+                    "end": end,
+                    "evictedUntil": self._records.evicted_until,
+                    "battleResults": battle_results,
+                }
+            )
+        )
+
+    def stats(self):
+        return self._records.stats()
+
+    def evict_records(self):
+        # type: () -> None
+        if self._records.evict() > 0:
+            self.generation += 1
+
+    @staticmethod
+    def _encode_columnar(record, battle_result):
+        # type: (BattleResultRecord, Any) -> int
+        encoded = serialize_to_json(columnarize_battle_results(battle_result))
+        record.columnar_battle_result = RawJson(encoded)
+        return len(encoded)
 
     def _on_battle_result(self, battle_result):
         # type: (Any) -> None
+        # battle results are only encoded once, the encoded size is what's retained
+        encoded = serialize_to_json(battle_result)
         record = BattleResultRecord(
-            timestamp=int(time.time()), battle_result=battle_result
+            timestamp=int(time.time()),
+            battle_result=RawJson(encoded),
+            size=len(encoded),
         )
 
+        # evaluate each distinct filter only once
+        matched_keys = dict()
+        streams_by_encoding = OrderedDict()
+        for stream, subscription in self._subscribers.iteritems():
+            if subscription.key not in matched_keys:
+                matched_keys[subscription.key] = matches(subscription, battle_result)
+            if matched_keys[subscription.key]:
+                encoding = (subscription.columnar, subscription.batched)
+                streams_by_encoding.setdefault(encoding, []).append(stream)
+
+        if any(columnar for columnar, _ in streams_by_encoding):
+            record.size += self._encode_columnar(record, battle_result)
+
         self._records.append(record)
+        self.generation += 1
+
+        params_by_columnar = dict()
+        for (columnar, batched), streams in streams_by_encoding.iteritems():
+            if columnar not in params_by_columnar:
+                if columnar:
+                    encoded_battle_result = record.columnar_battle_result
+                else:
+                    encoded_battle_result = record.battle_result
+
+                params_by_columnar[columnar] = {
+                    "battleResult": encoded_battle_result,
+                    "timestamp": record.timestamp,
+                }
+
+            params = params_by_columnar[columnar]
+            if batched:
+                self._pending_notifications.append(
+                    PendingNotification(params=params, streams=streams)
+                )
+            else:
+                notify(streams, "subscription", params)
 
-        params = {
-            "battleResult": record.battle_result,
-            "timestamp": record.timestamp,
-        }
+    def _on_battle_results_drained(self):
+        # type: () -> None
+        pending_notifications = self._pending_notifications
+        self._pending_notifications = []
 
-        for stream in self._subscribers:
-            notify(stream, "subscription", params)
+        batches = OrderedDict()  # type: Dict[MessageStream, List[Any]]
+        for pending in pending_notifications:
+            for stream in pending.streams:
+                if stream in self._subscribers:
+                    batches.setdefault(stream, []).append(pending.params)
 
+        # streams which received the same battle results share the same payload
+        streams_by_batch = OrderedDict()
+        for stream, batch in batches.iteritems():
+            batch_key = tuple(id(params) for params in batch)
+            streams_by_batch.setdefault(batch_key, (batch, []))[1].append(stream)
 
-def create_dispatcher(stream, handlers):
-    # type: (MessageStream, Handlers) -> Dispatcher
-    dispatcher = Dispatcher()
+        for batch, streams in streams_by_batch.itervalues():
+            notify(streams, "subscription", batch)
+
+
+class ConnectionContext(Context):
+    __slots__ = ("stream",)
+
+    def __init__(self, stream):
+        # type: (MessageStream) -> None
+        super(ConnectionContext, self).__init__(
+            rate_limiter=TokenBucket(REQUEST_RATE, REQUEST_BURST)
+        )
+        self.stream = stream
+
+
+GET_BATTLE_RESULTS_PARAMS = Nullable(
+    Record(
+        field("after", Number(), optional=True),
+        field("columnar", Boolean(), optional=True),
+    )
+)
 
-    @dispatcher.add_method()
-    def subscribe(params):
-        handlers.subscribe(stream)
+
+def get_battle_results_args(params):
+    # applies the defaults, so that equivalent params share a cache entry
+    after = get(params, "after")
+    return after or 0, bool(get(params, "columnar"))
+
+
+def create_dispatcher(handlers, metadata, load_shedder, response_cache):
+    # type: (Handlers, Metadata, LoadShedder, ResponseCache) -> Dispatcher
+    dispatcher = Dispatcher(
+        load_shedder=load_shedder,
+        bytes_per_token=BYTES_PER_TOKEN,
+        response_cache=response_cache,
+        max_batch_size=MAX_BATCH_SIZE,
+    )
+
+    @dispatcher.add_method(param_parser=SUBSCRIBE_PARAMS)
+    def subscribe(context, params):
+        handlers.subscribe(context.stream, params)
 
     @dispatcher.add_method()
-    def unsubscribe(params):
-        handlers.unsubscribe(stream)
+    def unsubscribe(context, params):
+        handlers.unsubscribe(context.stream)
 
     @dispatcher.add_method(
-        param_parser=Nullable(Record(field("after", Number(), optional=True)))
+        param_parser=GET_BATTLE_RESULTS_PARAMS, cache_key=get_battle_results_args
     )
-    def get_battle_results(params):
-        after = get(params, "after")
-        if after is None:
-            after = 0
+    def get_battle_results(context, params):
+        return handlers.get_battle_results(*get_battle_results_args(params))
 
-        return handlers.get_battle_results(after)
+    @dispatcher.add_method(is_async=True)
+    def get_metadata(context, params):
+        return metadata.load()
 
     return dispatcher
 
 
-def create_protocol(handlers, allowed_origins):
-    # type: (Handlers, List) -> ...
+def create_protocol(dispatcher, handlers, allowed_origins):
+    # type: (Dispatcher, Handlers, List) -> ...
     @websocket_protocol(allowed_origins=allowed_origins)
     @async_task
     def protocol(server, stream):
@@ -115,24 +365,26 @@ def create_protocol(handlers, allowed_origins):
         host, port = stream.peer_addr
         origin = stream.handshake_headers["origin"]
 
-        LOG_NOTE(
+        log_note(
             "{origin} ([{host}]:{port}) connected.".format(
                 origin=origin, host=host, port=port
             )
         )
 
-        dispatcher = create_dispatcher(stream, handlers)
+        context = ConnectionContext(stream)
+        responses = ResponseQueue(stream, MAX_PENDING_RESPONSES)
 
         try:
             while True:
                 data = yield stream.receive_message()
-                response = dispatcher(data)
-                if response:
-                    yield stream.send_message(response)
+                responses.put(dispatcher(context, data))
+                # stop reading while too many responses are pending
+                yield responses.wait_for_capacity()
         finally:
+            responses.close()
             handlers.unsubscribe(stream)
 
-            LOG_NOTE(
+            log_note(
                 "{origin} ([{host}]:{port}) disconnected.".format(
                     origin=origin, host=host, port=port
                 )
@@ -144,30 +396,75 @@ def create_protocol(handlers, allowed_origins):
 class BattleResultsServer(object):
     def __init__(self):
         self._keep_running = True
-        self._fetcher = BattleResultsFetcher()
+        self._metadata = Metadata()
+        self._fetcher = BattleResultsFetcher(
+            self._metadata if ENRICH_BATTLE_RESULTS else None
+        )
+        self._load_shedder = LoadShedder(FRAME_BUDGET)
+        self._handlers = None  # type: Optional[Handlers]
+        self._response_cache = None  # type: Optional[ResponseCache]
 
     @auto_run
     @async_task
-    def serve(self):
-        self._fetcher.start()
+    def serve(self, account_is_player=False):
+        g_io_worker.start()
 
-        LOG_NOTE("Starting server on port {}".format(PORT))
+        if TRACE_SAMPLE_RATE > 0:
+            g_tracer.enable(TRACE_SAMPLE_RATE)
 
-        protocol = create_protocol(Handlers(self._fetcher), ORIGIN_WHITELIST)
+        self._fetcher.start(account_is_player)
+
+        log_note("Starting server on port {}".format(PORT))
+
+        # read the metadata cache in the background, ahead of the first get_metadata
+        self._metadata.load()
+
+        handlers = Handlers(self._fetcher, RETENTION_POLICY)
+        self._handlers = handlers
+        self._response_cache = ResponseCache(
+            RESPONSE_CACHE_SIZE, RESPONSE_CACHE_BYTES, lambda: handlers.generation
+        )
+        dispatcher = create_dispatcher(
+            handlers, self._metadata, self._load_shedder, self._response_cache
+        )
+        protocol = create_protocol(dispatcher, handlers, ORIGIN_WHITELIST)
 
         try:
             with Server(protocol, PORT) as server:
                 while self._keep_running and not server.closed:
-                    server.poll()
+                    self._load_shedder.start_frame()
+                    g_io_worker.poll()
+                    handlers.evict_records()
+                    with g_tracer.span("poll"):
+                        server.poll()
                     yield delay(0)
         except CallbackCancelled:
             pass
         finally:
-            LOG_NOTE("Stopped server")
+            # a regular stop is logged by close(), before the I/O worker is closed
+            if self._keep_running:
+                log_note("Stopped server")
+
+    def stats(self):
+        stats = self._load_shedder.stats()
+        if self._response_cache is not None:
+            stats.update(self._response_cache.stats())
+        if self._handlers is not None:
+            stats.update(self._handlers.stats())
+        stats.update(g_io_worker.stats())
+        return stats
+
+    def dump_trace(self, path=TRACE_FILE):
+        g_io_worker.write_file(path, g_tracer.dump())
+        log_note("Dumping trace to {}".format(path))
 
     def close(self):
         self._keep_running = False
         self._fetcher.stop()
 
+        log_note("Server stats: {}".format(self.stats()))
+        log_note("Stopped server")
+        g_io_worker.close()
+
 
 g_battle_results_server = BattleResultsServer()
@@ -0,0 +1,103 @@
+from collections import namedtuple
+
+from mod_battle_results_server.parser import (
+    AllOf,
+    Any,
+    Array,
+    Boolean,
+    Contains,
+    Integer,
+    Member,
+    Nullable,
+    ParserError,
+    Record,
+    Satisfies,
+    field,
+    parse,
+)
+from mod_battle_results_server.util import get, normalize_json
+
+SUBSCRIBE_PARAMS = Nullable(
+    Record(
+        field("bonusTypes", Array(Integer()), optional=True),
+        field("vehicles", Array(Integer()), optional=True),
+        field("ownResultsOnly", Boolean(), optional=True),
+        field("batched", Boolean(), optional=True),
+        field("columnar", Boolean(), optional=True),
+    )
+)
+
+FILTER_PARAMS = ("bonusTypes", "vehicles", "ownResultsOnly")
+
+Subscription = namedtuple("Subscription", ("key", "filter", "batched", "columnar"))
+
+
+def create_subscription(params, get_account_dbid):
+    filter_params = {name: get(params, name) for name in FILTER_PARAMS}
+    return Subscription(
+        key=normalize_json(filter_params),
+        filter=compile_filter(params, get_account_dbid),
+        batched=bool(get(params, "batched")),
+        columnar=bool(get(params, "columnar")),
+    )
+
+
+def compile_filter(params, get_account_dbid):
+    conditions = []
+
+    bonus_types = get(params, "bonusTypes")
+    if bonus_types is not None:
+        conditions.append(
+            Record(field("common", Record(field("bonusType", Member(bonus_types)))))
+        )
+
+    vehicles = get(params, "vehicles")
+    if vehicles is not None:
+        conditions.append(
+            Record(
+                field(
+                    "personal",
+                    Contains(Record(field("typeCompDescr", Member(vehicles)))),
+                )
+            )
+        )
+
+    if get(params, "ownResultsOnly"):
+
+        def is_own_account(account_dbid):
+            own_account_dbid = get_account_dbid()
+            return own_account_dbid is not None and str(account_dbid) == str(
+                own_account_dbid
+            )
+
+        conditions.append(
+            Record(
+                field(
+                    "personal",
+                    Record(
+                        field(
+                            "avatar",
+                            Record(
+                                field(
+                                    "accountDBID",
+                                    Satisfies(is_own_account, "the own account"),
+                                )
+                            ),
+                        )
+                    ),
+                )
+            )
+        )
+
+    if len(conditions) == 0:
+        return Any()
+
+    return AllOf(*conditions)
+
+
+def matches(subscription, battle_result):
+    try:
+        parse(subscription.filter, battle_result)
+    except ParserError:
+        return False
+    return True
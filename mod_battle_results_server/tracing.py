@@ -0,0 +1,132 @@
+import json
+import random
+from collections import deque
+from timeit import default_timer
+
+# number of trace events which are kept in the ring buffer
+TRACE_BUFFER_SIZE = 20000
+
+# thread ids used for laying out the trace in the Chrome trace viewer
+SYNC_TID = 0
+ASYNC_TID = 1
+
+
+class Tracer(object):
+    """
+    Records spans into a ring buffer which can be dumped as Chrome trace event JSON
+    (chrome://tracing, Perfetto). Tracing is disabled by default. Sampling decisions
+    are made per root span, nested spans are recorded together with their root.
+    """
+
+    def __init__(self, capacity=TRACE_BUFFER_SIZE, clock=default_timer):
+        self._events = deque(maxlen=capacity)
+        self._clock = clock
+        self._sample_rate = 0.0
+        self._depth = 0
+        self._sampled = False
+
+    @property
+    def enabled(self):
+        return self._sample_rate > 0
+
+    def enable(self, sample_rate=1.0):
+        self._sample_rate = sample_rate
+
+    def disable(self):
+        self._sample_rate = 0.0
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return _noop_span
+        return _Span(self, name, args)
+
+    def async_span(self, name, **args):
+        if not self.enabled or random.random() >= self._sample_rate:
+            return _noop_span
+        return _AsyncSpan(self, name, args)
+
+    def clear(self):
+        self._events.clear()
+
+    def dump(self):
+        return json.dumps({"traceEvents": list(self._events)})
+
+    def _now(self):
+        return self._clock() * 1000000
+
+    def _record(self, name, tid, start, args):
+        self._events.append(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": start,
+                "dur": self._now() - start,
+                "pid": 0,
+                "tid": tid,
+                "args": args,
+            }
+        )
+
+
+class _Span(object):
+    __slots__ = ("_tracer", "_name", "_args", "_start", "_sampled")
+
+    def __init__(self, tracer, name, args):
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+        self._start = None
+        self._sampled = False
+
+    def set(self, **args):
+        self._args.update(args)
+
+    def __enter__(self):
+        tracer = self._tracer
+        if tracer._depth == 0:
+            tracer._sampled = random.random() < tracer._sample_rate
+        tracer._depth += 1
+        self._sampled = tracer._sampled
+        if self._sampled:
+            self._start = tracer._now()
+        return self
+
+    def __exit__(self, *_):
+        self._tracer._depth -= 1
+        if self._sampled:
+            self._tracer._record(self._name, SYNC_TID, self._start, self._args)
+
+
+class _AsyncSpan(object):
+    __slots__ = ("_tracer", "_name", "_args", "_start")
+
+    def __init__(self, tracer, name, args):
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+        self._start = tracer._now()
+
+    def set(self, **args):
+        self._args.update(args)
+
+    def finish(self):
+        self._tracer._record(self._name, ASYNC_TID, self._start, self._args)
+
+
+class _NoopSpan(object):
+    def set(self, **args):
+        pass
+
+    def finish(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+
+_noop_span = _NoopSpan()
+
+g_tracer = Tracer()
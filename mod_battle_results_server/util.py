@@ -1,4 +1,5 @@
 import json
+import os
 from functools import wraps
 
 from debug_utils import LOG_CURRENT_EXCEPTION
@@ -38,6 +39,41 @@ def serialize_to_json(obj):
     return json.dumps(obj)
 
 
+def normalize_json(obj):
+    return json.dumps(obj, sort_keys=True)
+
+
+class RawJson(object):
+    __slots__ = ("json",)
+
+    def __init__(self, json_string):
+        self.json = json_string
+
+
+def serialize_with_raw_json(obj):
+    # meant for small envelopes around already serialized payloads
+    if isinstance(obj, RawJson):
+        return obj.json
+    if isinstance(obj, dict):
+        return (
+            "{"
+            + ", ".join(
+                json.dumps(str(key)) + ": " + serialize_with_raw_json(value)
+                for key, value in obj.iteritems()
+            )
+            + "}"
+        )
+    if isinstance(obj, (list, tuple)):
+        return "[" + ", ".join(serialize_with_raw_json(value) for value in obj) + "]"
+    return json.dumps(obj)
+
+
+def get_data_dir():
+    import BigWorld
+
+    return os.path.dirname(BigWorld.wg_getPreferencesFilePath())
+
+
 def safe_callback(func):
     @wraps(func)
     def wrapper(*args, **kwargs):